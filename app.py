@@ -1,35 +1,496 @@
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import base64
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import stat
+import tempfile
+import time
 import pytz
 import requests
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 
 app = Flask(__name__)
 
-# Configura il logging per catturare i dettagli degli errori
-logging.basicConfig(level=logging.DEBUG)
+# Configura il logging per catturare i dettagli degli errori.
+# In produzione LOG_LEVEL=INFO (o WARNING) elimina i log di debug di ogni richiesta
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+logging.basicConfig(level=LOG_LEVEL)
+
+# Modalità di rendering: "full" disegna sul template a piena risoluzione e poi lo riduce con LANCZOS,
+# "scaled" disegna direttamente alla risoluzione di output. "scaled" è molto più veloce ma cambia
+# visibilmente il certificato (il font a 40.5pt ha un hinting diverso: circa il 4% dei pixel differisce
+# di più di 8 livelli, vedi bench/bench_render.py), quindi va attivata esplicitamente
+RENDER_MODE = os.environ.get("RENDER_MODE", "full")
+
+# Fattore di scala dell'immagine finale rispetto al template originale
+SCALA_OUTPUT = 0.5
+
+# Layout del certificato, in coordinate del template a piena risoluzione
+POS_CODICE_SOPRA = (2980.39, 588.83)
+POS_CODICE_SOTTO = (-50.57, 1494.53)
+POS_CENTRO_X = 871.07
+POS_CENTRO_Y = [694.60, 806.92, 919.24, 1031.56, 1143.87]
+DIM_FONT_CODICE = 326
+DIM_FONT_CENTRO = 81
+
+# Colori e trasparenza
+COLORE_SOPRA = (134, 81, 0, int(28 * 2.55))
+COLORE_SOTTO = (31, 59, 0, int(63 * 2.55))
+COLORE_CENTRO = (43, 43, 43, 255)
+
+# Etichette fisse delle righe centrali, disegnate una sola volta sul template
+ETICHETTE_CENTRO = [
+    "Titolare:",
+    "Importo Investito:",
+    "Rendimento Promesso:",
+    "Data di Scadenza:",
+    "Codice di Riferimento Unico:"
+]
+
+# Margine in pixel attorno al bounding box di ogni testo composto per regioni
+MARGINE_REGIONE = 2
+
+# Memoria massima in byte (pixel RGBA) dei testi renderizzati tenuti in cache
+SPRITE_CACHE_MAX_BYTES = int(os.environ.get("SPRITE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Cache LRU con capienza massima e contatori di hit/miss.
+# Se è indicata una funzione peso, la capienza si misura in peso (per esempio byte) invece che in voci.
+# Se è indicato un nome, hit e miss vengono anche esposti su /metrics con l'etichetta cache=<nome>
+class CacheLRU:
+    def __init__(self, capacita, peso=None, nome=None):
+        self.capacita = capacita
+        self.nome = nome
+        self.peso = peso or (lambda valore: 1)
+        self.occupazione = 0
+        self.voci = OrderedDict()
+        self.lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+
+    def get(self, chiave):
+        with self.lock:
+            if chiave in self.voci:
+                self.voci.move_to_end(chiave)
+                self.hit += 1
+                valore = self.voci[chiave]
+            else:
+                self.miss += 1
+                valore = None
+        if self.nome:
+            (cache_hit if valore is not None else cache_miss).labels(self.nome).inc()
+        return valore
+
+    def put(self, chiave, valore):
+        with self.lock:
+            if chiave in self.voci:
+                self.occupazione -= self.peso(self.voci.pop(chiave))
+            self.voci[chiave] = valore
+            self.occupazione += self.peso(valore)
+            while self.occupazione > self.capacita and self.voci:
+                _, scartato = self.voci.popitem(last=False)
+                self.occupazione -= self.peso(scartato)
+
+    # Rimuove tutte le voci per cui condizione(valore) è vera
+    def rimuovi_se(self, condizione):
+        with self.lock:
+            for chiave in [chiave for chiave, valore in self.voci.items() if condizione(valore)]:
+                self.occupazione -= self.peso(self.voci.pop(chiave))
+
+    def statistiche(self):
+        with self.lock:
+            richieste = self.hit + self.miss
+            return {
+                "dimensione": len(self.voci),
+                "occupazione": self.occupazione,
+                "capacita": self.capacita,
+                "hit": self.hit,
+                "miss": self.miss,
+                "hit_rate": self.hit / richieste if richieste else 0.0
+            }
+
+# Limiti superiori in secondi dei bucket degli istogrammi di durata
+BUCKET_DURATA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Errori conteggiati ed esposti su /metrics
+TIPI_ERRORE = ("tipo_sconosciuto", "codifica_non_valida", "google_sheet", "fivemanage", "generazione")
+
+# Metriche Prometheus: durata di ogni fase, errori e hit/miss delle cache.
+# Se è impostata PROMETHEUS_MULTIPROC_DIR (vedi gunicorn.conf.py) ogni processo scrive i propri valori
+# in quella cartella e /metrics li somma, così ogni scrape vede il totale di tutti i worker
+durata_fasi = Histogram(
+    "ws_fase_durata_secondi", "Durata delle fasi di generazione del certificato", ["fase"], buckets=BUCKET_DURATA
+)
+contatori_errori = Counter("ws_errori", "Errori durante la generazione dei certificati", ["tipo"])
+cache_hit = Counter("ws_cache_hit", "Richieste servite dalle cache di rendering", ["cache"])
+cache_miss = Counter("ws_cache_miss", "Richieste non trovate nelle cache di rendering", ["cache"])
+for tipo in TIPI_ERRORE:
+    contatori_errori.labels(tipo)
+
+# Context manager che registra la durata di una fase della generazione
+@contextmanager
+def misura(fase):
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        durata_fasi.labels(fase).observe(time.perf_counter() - inizio)
+
+# Funzione per conteggiare un errore
+def conta_errore(tipo):
+    contatori_errori.labels(tipo).inc()
+
+# Servizi esterni, sovrascrivibili per puntare a un server di test locale
+GOOGLE_SHEET_URL = os.environ.get(
+    "GOOGLE_SHEET_URL",
+    "https://script.google.com/macros/s/AKfycbxJ7qR7z8OHWt6KSYo2UoRQjRzipiRgRoYS6ecUUOIZCxXOwHIbyiJh3KicCtEjKZEj/exec"
+)
+FIVEMANAGE_URL = os.environ.get("FIVEMANAGE_URL", "https://api.fivemanage.com/api/image")
+FIVEMANAGE_API_KEY = os.environ.get("FIVEMANAGE_API_KEY", "LvTU9eoJ9aVelrBG7ClyjbaAifIvhxHi")
+
+# Timeout (connessione, lettura) in secondi, retry con backoff esponenziale e connessioni per host.
+# Nel caso peggiore una chiamata fa HTTP_RETRIES + 1 tentativi, ognuno fino a connessione più lettura,
+# più il backoff tra un tentativo e l'altro: con i valori predefiniti 3 x 13,05 s + 1 s, circa 40 s.
+# L'header Retry-After viene ignorato, altrimenti il server potrebbe far attendere il worker
+# per un tempo qualsiasi. Sheet più upload (circa 2 x 40 s) restano entro il timeout di gunicorn.conf.py
+HTTP_TIMEOUT = (
+    float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.05")),
+    float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+)
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", "0.5"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "8"))
+
+# Processi usati per renderizzare i batch e numero massimo di voci per batch.
+# Ogni worker gunicorn ha il proprio pool: di default le CPU vengono divise tra i worker
+# (vedi on_starting in gunicorn.conf.py), altrimenti W worker avvierebbero W x CPU processi,
+# ognuno con l'app importata e la propria cache dei testi. Il pool viene chiuso dopo
+# BATCH_POOL_INATTIVO secondi senza batch e ricreato al batch successivo.
+# Un worker sync di gunicorn viene terminato se una richiesta, streaming compreso, supera il timeout
+# di gunicorn.conf.py: con una sola CPU una voce richiede circa 0,4 s tra rendering e codifica, quindi
+# 40 voci (circa 16 s, in parallelo allo Sheet) più Sheet e un upload con tutti i retry (circa 2 x 40 s)
+# restano entro 90 s. Se più upload dello stesso batch esauriscono i retry il batch può superarlo.
+# Se si alza BATCH_MAX_VOCI va alzato anche GUNICORN_TIMEOUT
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 1)))
+BATCH_MAX_VOCI = int(os.environ.get("BATCH_MAX_VOCI", "40"))
+BATCH_POOL_INATTIVO = float(os.environ.get("BATCH_POOL_INATTIVO", "60"))
+
+# Sessione HTTP condivisa, executor per le chiamate in parallelo e pool di processi, creati alla prima richiesta
+risorse_lock = threading.Lock()
+http_session = None
+io_executor = None
+process_pool = None
+batch_in_corso = 0
+ultimo_batch = 0.0
+
+# Codifica predefinita dell'immagine finale, sovrascrivibile per singola richiesta.
+# Con OUTPUT_RGB l'alpha viene scartato se il template è opaco (l'immagine finale lo è comunque)
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "png")
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "3"))
+WEBP_LOSSLESS = os.environ.get("WEBP_LOSSLESS", "0") == "1"
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", "90"))
+WEBP_METHOD = int(os.environ.get("WEBP_METHOD", "4"))
+OUTPUT_RGB = os.environ.get("OUTPUT_RGB", "1") == "1"
+
+# Formati di output supportati e relativo content type
+FORMATI_OUTPUT = {
+    "png": "image/png",
+    "webp": "image/webp"
+}
+
+# Cache delle immagini già generate e caricate: byte massimi in memoria, cartella opzionale su disco
+# e byte massimi su disco. La chiave contiene il codice di riferimento, che cambia ogni minuto:
+# un'immagine può essere richiesta di nuovo solo entro RENDER_CACHE_DURATA secondi dal salvataggio,
+# dopo viene eliminata
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR")
+RENDER_CACHE_DIR_MAX_BYTES = int(os.environ.get("RENDER_CACHE_DIR_MAX_BYTES", str(256 * 1024 * 1024)))
+RENDER_CACHE_DURATA = 60
+
+# File da cui dipende l'aspetto del certificato: se cambiano, le immagini in cache non sono più valide
+FILE_RISORSE = [
+    "static/image.webp",
+    "fonts/lumios_typewriter_new.otf",
+    "fonts/lumios_typewriter_tape.otf"
+]
+
+# Cartella in cui salvare i pixel RGBA grezzi del template, mappati in memoria in sola lettura
+# e quindi condivisi tra tutti i worker. I file vengono scritti in una sottocartella privata
+# dell'utente (ws-<uid>, permessi 0700). Vuota per tenere il template nella memoria di ogni processo
+TEMPLATE_SHM_DIR = os.environ.get(
+    "TEMPLATE_SHM_DIR",
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
 
 # Cache per risorse statiche (immagini e font)
-base_image = None
+templates_cache = {}
+dimensioni_templates = {}
+template_opaco = None
 fonts_cache = {}
+fonts_dati = {}
+
+# Cache dei testi già renderizzati, indicizzata per font, dimensione, testo e colore
+sprite_cache = CacheLRU(SPRITE_CACHE_MAX_BYTES, peso=lambda sprite: sprite[0].width * sprite[0].height * 4, nome="sprite")
 
-# Funzione per ottenere l'immagine di base
-def get_base_image():
-    global base_image
-    if base_image is None:
-        base_image = Image.open("static/image.webp").convert("RGBA")
-    return base_image.copy()
+# Cache delle immagini generate, indicizzata per hash dei dati del certificato e delle risorse
+render_cache = CacheLRU(RENDER_CACHE_MAX_BYTES, peso=lambda voce: len(voce["immagine"]), nome="render")
+render_cache_disco_hit = 0
+versione_risorse = None
 
-# Funzione per ottenere il font dalla cache
+# Funzione per caricare l'immagine di base, eventualmente ridotta alla scala richiesta
+def carica_base_image(scala=1.0):
+    image = Image.open("static/image.webp").convert("RGBA")
+    if scala != 1.0:
+        new_size = (int(image.width * scala), int(image.height * scala))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+    return image
+
+# Funzione per ottenere il font dalla cache.
+# Il file viene letto una volta sola e il font caricato dalla memoria: così FreeType non tiene
+# aperto un file il cui offset, dopo il fork, sarebbe condiviso tra i worker
 def get_font(name, size):
     key = f"{name}-{size}"
     if key not in fonts_cache:
-        fonts_cache[key] = ImageFont.truetype(f"fonts/{name}.otf", size)
+        if name not in fonts_dati:
+            with open(f"fonts/{name}.otf", "rb") as f:
+                fonts_dati[name] = f.read()
+        fonts_cache[key] = ImageFont.truetype(BytesIO(fonts_dati[name]), size)
     return fonts_cache[key]
 
+# Funzione per tagliare un testo allineato a sinistra ai caratteri che iniziano entro la larghezza visibile
+def taglia_testo_visibile(font, testo, larghezza):
+    if font.getlength(testo) <= larghezza:
+        return testo
+    # Ricerca binaria del prefisso più lungo che termina prima del bordo
+    minimo, massimo = 0, len(testo)
+    while minimo < massimo:
+        medio = (minimo + massimo + 1) // 2
+        if font.getlength(testo[:medio]) < larghezza:
+            minimo = medio
+        else:
+            massimo = medio - 1
+    # Il carattere a cavallo del bordo resta, per disegnarne la parte visibile
+    return testo[:minimo + 1]
+
+# Funzione per renderizzare un testo su un layer grande quanto la parte visibile del suo bounding box.
+# Restituisce il layer e lo scostamento del suo angolo rispetto alla parte intera della posizione,
+# oppure None se il testo cade interamente fuori dall'immagine di dimensioni `canvas`
+def renderizza_sprite(nome_font, size, testo, colore, anchor, xy, canvas):
+    font = get_font(nome_font, size)
+    origine_x, origine_y = math.floor(xy[0]), math.floor(xy[1])
+    fase = (xy[0] - origine_x, xy[1] - origine_y)
+
+    # I caratteri oltre il bordo destro non vengono nemmeno rasterizzati
+    if anchor is None or anchor.startswith("l"):
+        testo = taglia_testo_visibile(font, testo, canvas[0] - xy[0] + MARGINE_REGIONE)
+    left, top, right, bottom = font.getbbox(testo, anchor=anchor)
+
+    # Margine per la parte frazionaria della posizione e per l'antialiasing,
+    # poi ritaglio alla parte del bounding box che cade dentro l'immagine
+    left = max(left - MARGINE_REGIONE, -origine_x)
+    top = max(top - MARGINE_REGIONE, -origine_y)
+    right = min(right + MARGINE_REGIONE, canvas[0] - origine_x)
+    bottom = min(bottom + MARGINE_REGIONE, canvas[1] - origine_y)
+    if right <= left or bottom <= top:
+        return None
+
+    txt_layer = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(txt_layer)
+    draw.text((fase[0] - left, fase[1] - top), testo, font=font, fill=colore, anchor=anchor)
+    return txt_layer, left, top
+
+# Funzione per ottenere un testo renderizzato dalla cache
+def get_sprite(nome_font, size, testo, colore, anchor, xy, canvas):
+    # La posizione fa parte della chiave: la fase sub-pixel cambia l'antialiasing e il bordo il ritaglio
+    key = (nome_font, size, testo, colore, anchor, xy, canvas)
+    sprite = sprite_cache.get(key)
+    if sprite is None:
+        sprite = renderizza_sprite(nome_font, size, testo, colore, anchor, xy, canvas)
+        if sprite is not None:
+            sprite_cache.put(key, sprite)
+    return sprite
+
+# Funzione per comporre un testo renderizzato solo sulla sua regione dell'immagine,
+# invece che tramite un layer grande quanto l'intero template
+def componi_sprite(image, xy, sprite):
+    if sprite is None:
+        return
+    txt_layer, scostamento_x, scostamento_y = sprite
+    origine_x = math.floor(xy[0]) + scostamento_x
+    origine_y = math.floor(xy[1]) + scostamento_y
+
+    # Le coordinate negative vanno ritagliate dal layer: alpha_composite accetta solo destinazioni positive
+    source = (max(0, -origine_x), max(0, -origine_y))
+    dest = (max(0, origine_x), max(0, origine_y))
+    if source[0] >= txt_layer.width or source[1] >= txt_layer.height:
+        return
+    image.alpha_composite(txt_layer, dest=dest, source=source)
+
+# Funzione per ottenere il testo renderizzato da comporre nella posizione indicata
+def sprite_testo(xy, canvas, testo, nome_font, size, colore, anchor=None):
+    return xy, get_sprite(nome_font, size, testo, colore, anchor, xy, canvas)
+
+# Funzione per ottenere le dimensioni del template alla scala richiesta.
+# Si leggono dall'intestazione del file, senza decodificare l'immagine
+def dimensioni_template(scala):
+    if scala not in dimensioni_templates:
+        with Image.open("static/image.webp") as originale:
+            dimensioni_templates[scala] = (int(originale.width * scala), int(originale.height * scala))
+    return dimensioni_templates[scala]
+
+# Funzione per ottenere il template con le etichette fisse già disegnate
+def get_template(scala=1.0):
+    if scala not in templates_cache:
+        if TEMPLATE_SHM_DIR:
+            templates_cache[scala] = carica_template_condiviso(scala)
+        else:
+            templates_cache[scala] = costruisci_template(scala)
+    return templates_cache[scala].copy()
+
+# Funzione per disegnare le etichette fisse sull'immagine di base
+def costruisci_template(scala):
+    image = carica_base_image(scala)
+    size = DIM_FONT_CENTRO * scala
+    for etichetta, y in zip(ETICHETTE_CENTRO, POS_CENTRO_Y):
+        xy = (POS_CENTRO_X * scala, y * scala)
+        sprite = renderizza_sprite("lumios_typewriter_new", size, etichetta, COLORE_CENTRO, None, xy, image.size)
+        componi_sprite(image, xy, sprite)
+    return image
+
+# Funzione per ottenere la sottocartella privata dei template condivisi dentro TEMPLATE_SHM_DIR.
+# /dev/shm è scrivibile da tutti: la cartella deve appartenere all'utente corrente e non essere
+# accessibile ad altri, altrimenti un altro utente potrebbe sostituire il template
+def cartella_template_condiviso():
+    cartella = os.path.join(TEMPLATE_SHM_DIR, f"ws-{os.getuid()}")
+    os.makedirs(cartella, mode=0o700, exist_ok=True)
+    info = os.lstat(cartella)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"La cartella {cartella} non è privata dell'utente corrente")
+    return cartella
+
+# Funzione per ottenere il template come immagine in sola lettura sopra un file RGBA mappato in memoria.
+# Il primo processo che non trova il file lo crea; gli altri mappano le stesse pagine,
+# quindi il template decodificato occupa memoria una sola volta per tutti i worker
+def carica_template_condiviso(scala):
+    dimensioni = dimensioni_template(scala)
+
+    # Il nome dipende da risorse, layout delle etichette e scala: un file non aggiornato non viene mai riusato
+    layout = json.dumps([ETICHETTE_CENTRO, POS_CENTRO_X, POS_CENTRO_Y, DIM_FONT_CENTRO, COLORE_CENTRO, MARGINE_REGIONE])
+    versione = hashlib.sha256(f"{get_versione_risorse()}{layout}".encode("utf-8")).hexdigest()[:16]
+    nome = f"ws_template_{versione}_{dimensioni[0]}x{dimensioni[1]}.rgba"
+
+    try:
+        cartella = cartella_template_condiviso()
+        percorso = os.path.join(cartella, nome)
+        if not os.path.exists(percorso) or os.path.getsize(percorso) != dimensioni[0] * dimensioni[1] * 4:
+            image = costruisci_template(scala)
+            # Scrittura su un file temporaneo nuovo (O_EXCL, 0600) e rename, così un altro worker
+            # non mappa mai un file a metà
+            descrittore, temporaneo = tempfile.mkstemp(prefix=f"{nome}.", suffix=".tmp", dir=cartella)
+            try:
+                with os.fdopen(descrittore, "wb") as f:
+                    f.write(image.tobytes())
+                os.replace(temporaneo, percorso)
+            except OSError:
+                os.remove(temporaneo)
+                raise
+            rimuovi_template_obsoleti(cartella, versione)
+        with open(percorso, "rb") as f:
+            mappa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as e:
+        logging.error(f"Impossibile condividere il template in {TEMPLATE_SHM_DIR}: {str(e)}")
+        return costruisci_template(scala)
+    return Image.frombuffer("RGBA", dimensioni, mappa, "raw", "RGBA", 0, 1)
+
+# Funzione per eliminare i template condivisi di versioni precedenti, compresi i temporanei rimasti
+# da scritture interrotte. I processi che li hanno ancora mappati continuano a leggerli normalmente
+def rimuovi_template_obsoleti(cartella, versione):
+    for nome in os.listdir(cartella):
+        if nome.startswith("ws_template_") and not nome.startswith(f"ws_template_{versione}_"):
+            try:
+                os.remove(os.path.join(cartella, nome))
+            except OSError as e:
+                logging.warning(f"Impossibile eliminare il template obsoleto {nome}: {str(e)}")
+
+# Funzione per caricare template, font e hash delle risorse prima di servire richieste.
+# Con `gunicorn --preload` (vedi gunicorn.conf.py) viene eseguita nel master prima del fork,
+# così i worker non pagano la decodifica alla prima richiesta
+def precarica_risorse():
+    scala = SCALA_OUTPUT if RENDER_MODE == "scaled" else 1.0
+    get_template(scala)
+    get_font("lumios_typewriter_tape", DIM_FONT_CODICE * scala)
+    get_font("lumios_typewriter_new", DIM_FONT_CENTRO * scala)
+    is_template_opaco()
+    get_versione_risorse()
+
+# Funzione per sapere se il template è completamente opaco, e quindi anche ogni certificato
+def is_template_opaco():
+    global template_opaco
+    if template_opaco is None:
+        image = Image.open("static/image.webp")
+        template_opaco = "A" not in image.getbands() or image.getchannel("A").getextrema()[0] == 255
+    return template_opaco
+
+# Funzione per disegnare il certificato alla risoluzione di output
+def renderizza_certificato(codice_riferimento, valori_centro, modalita=None):
+    modalita = modalita or RENDER_MODE
+    if modalita not in ("scaled", "full"):
+        raise ValueError(f"Modalità di rendering non valida: {modalita}")
+
+    # In modalità "scaled" template, font e coordinate sono già alla scala di output
+    scala = SCALA_OUTPUT if modalita == "scaled" else 1.0
+
+    # Font dalla cache
+    size_codice = DIM_FONT_CODICE * scala
+    size_centro = DIM_FONT_CENTRO * scala
+    font_center = get_font("lumios_typewriter_new", size_centro)
+
+    # Renderizza (o prendi dalla cache) tutti i testi da comporre, ritagliati alle dimensioni del template
+    canvas = dimensioni_template(scala)
+    with misura("disegno"):
+        testi = []
+
+        # Posizione del testo sopra (con opacità al 28%)
+        x, y = POS_CODICE_SOPRA
+        testi.append(sprite_testo((x * scala, y * scala), canvas, codice_riferimento, "lumios_typewriter_tape", size_codice, COLORE_SOPRA, anchor="rd"))
+
+        # Valori delle righe centrali, subito dopo la rispettiva etichetta
+        for etichetta, valore, y in zip(ETICHETTE_CENTRO, valori_centro, POS_CENTRO_Y):
+            x = POS_CENTRO_X * scala + font_center.getlength(f"{etichetta} ")
+            testi.append(sprite_testo((x, y * scala), canvas, valore, "lumios_typewriter_new", size_centro, COLORE_CENTRO))
+
+        # Posizione del testo sotto (con opacità al 63%)
+        x, y = POS_CODICE_SOTTO
+        testi.append(sprite_testo((x * scala, y * scala), canvas, codice_riferimento, "lumios_typewriter_tape", size_codice, COLORE_SOTTO, anchor="la"))
+
+    # Componi i testi sul template con le etichette già disegnate
+    with misura("composizione"):
+        final_image = get_template(scala)
+        for xy, sprite in testi:
+            componi_sprite(final_image, xy, sprite)
+
+    # In modalità "full" riduci le dimensioni dell'immagine alla risoluzione di output
+    if modalita == "full":
+        with misura("ridimensionamento"):
+            new_size = (int(final_image.width * SCALA_OUTPUT), int(final_image.height * SCALA_OUTPUT))
+            final_image = final_image.resize(new_size, Image.Resampling.LANCZOS)
+
+    return final_image
+
 # Funzione aggiornata per calcolare la data di scadenza basata sul tipo di investimento
 def calcola_data_scadenza(tipo_investimento):
     if '7GG' in tipo_investimento:
@@ -49,17 +510,64 @@ def genera_codice_riferimento():
     now = datetime.now(fuso_orario_italia)
     return now.strftime("%d%m%Y%H%M")
 
+# Funzione per ottenere la sessione HTTP condivisa, con connessioni keep-alive e retry con backoff.
+# Viene creata alla prima richiesta di ogni processo, quindi dopo il fork dei worker gunicorn
+def get_http_session():
+    global http_session
+    with risorse_lock:
+        if http_session is None:
+            # Si ripetono solo le richieste che il server non ha elaborato: errori di connessione
+            # e risposte 429/503. Un errore di lettura o un 502/504 del gateway significano che la
+            # richiesta può essere già arrivata, e ripeterla duplicherebbe la riga sul foglio o l'upload
+            retry = Retry(
+                total=HTTP_RETRIES,
+                connect=HTTP_RETRIES,
+                read=0,
+                status=HTTP_RETRIES,
+                other=0,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(429, 503),
+                allowed_methods=None,
+                respect_retry_after_header=False
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_session = session
+        return http_session
+
+# Funzione per ottenere l'executor usato per le chiamate HTTP in parallelo al rendering
+def get_io_executor():
+    global io_executor
+    with risorse_lock:
+        if io_executor is None:
+            io_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="io")
+        return io_executor
+
 # Funzione per inviare i dati a Google Sheet tramite Apps Script
 def invia_a_google_sheet(nome, importo, tipo_investimento, data_investimento):
     try:
-        url = "https://script.google.com/macros/s/AKfycbxJ7qR7z8OHWt6KSYo2UoRQjRzipiRgRoYS6ecUUOIZCxXOwHIbyiJh3KicCtEjKZEj/exec"
+        url = GOOGLE_SHEET_URL
         payload = {
             'nome': nome,
             'importo': importo,
             'tipo_investimento': tipo_investimento,
             'data_investimento': data_investimento
         }
-        response = requests.post(url, data=payload)
+        with misura("google_sheet"):
+            response = get_http_session().post(url, data=payload, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        logging.error(f"Errore durante l'invio dei dati a Google Sheet: {str(e)}")
+        return False
+
+# Funzione per inviare più righe a Google Sheet con una sola chiamata all'Apps Script
+def invia_righe_a_google_sheet(righe):
+    try:
+        with misura("google_sheet"):
+            response = get_http_session().post(GOOGLE_SHEET_URL, json={"righe": righe}, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         return True
     except Exception as e:
@@ -67,10 +575,10 @@ def invia_a_google_sheet(nome, importo, tipo_investimento, data_investimento):
         return False
 
 # Funzione per caricare l'immagine su FiveManage
-def carica_su_fivemanage(image_buffer, api_key):
+def carica_su_fivemanage(image_buffer, api_key, formato="png"):
     try:
         # Endpoint per l'upload dell'immagine
-        url = "https://api.fivemanage.com/api/image"
+        url = FIVEMANAGE_URL
 
         # Header di autorizzazione
         headers = {
@@ -79,15 +587,16 @@ def carica_su_fivemanage(image_buffer, api_key):
 
         # L'immagine deve essere inviata come parte di `multipart/form-data`
         files = {
-            "file": ("image.png", image_buffer, "image/png")
+            "file": (f"image.{formato}", image_buffer, FORMATI_OUTPUT[formato])
         }
 
         # Esegui la richiesta POST
-        response = requests.post(url, headers=headers, files=files)
+        with misura("upload"):
+            response = get_http_session().post(url, headers=headers, files=files, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
 
         # Log di debug per visualizzare la risposta
-        logging.debug(f"Risposta da FiveManage: {response.text}")
+        logging.debug("Risposta da FiveManage: %s", response.text)
 
         # Restituisci il URL dell'immagine se tutto va bene
         return response.json().get("url")
@@ -99,6 +608,234 @@ def carica_su_fivemanage(image_buffer, api_key):
         return None
 
 
+# Funzione per mappare il rendimento selezionato al tipo di investimento
+def mappa_tipo_investimento(rendimento_selezionato):
+    if rendimento_selezionato == "11%":
+        return "7GG"
+    elif rendimento_selezionato == "25%":
+        return "BASSO 14GG"
+    elif rendimento_selezionato == "37%":
+        return "BASSO 21GG"
+    elif "23%" in rendimento_selezionato:
+        return "ALTO 14GG"
+    elif "34%" in rendimento_selezionato:
+        return "ALTO 21GG"
+    else:
+        return "UNKNOWN"
+
+# Funzione per preparare i dati di un certificato a partire dai parametri del form.
+# Se l'importo non è indicato, sul certificato compare "40.000,00 $" e sul foglio "40000"
+def prepara_certificato(nome, importo, rendimento_selezionato):
+    importo_foglio = importo if importo is not None else "40000"
+    importo = importo if importo is not None else "40.000,00 $"
+    tipo_investimento = mappa_tipo_investimento(rendimento_selezionato)
+    codice_riferimento = genera_codice_riferimento()
+    data_scadenza = calcola_data_scadenza(tipo_investimento)
+
+    # Data dell'investimento (la data corrente)
+    fuso_orario_italia = pytz.timezone('Europe/Rome')
+    data_investimento = datetime.now(fuso_orario_italia).strftime("%d/%m/%Y")
+
+    return {
+        "nome": nome.replace("_", " "),
+        "importo": importo_foglio.replace(".", "").replace(",", "").replace("$", ""),
+        "tipo_investimento": tipo_investimento,
+        "data_investimento": data_investimento,
+        "codice_riferimento": codice_riferimento,
+        # Valori personalizzati delle righe centrali (le etichette sono già nel template)
+        "valori_centro": [
+            nome.replace("_", " "),
+            importo,
+            'variabile dal 23% al 30%' if '23%' in rendimento_selezionato else rendimento_selezionato,
+            data_scadenza,
+            codice_riferimento
+        ]
+    }
+
+# Funzione per leggere i parametri di codifica della richiesta, con i valori predefiniti della configurazione
+def leggi_codifica(parametri):
+    formato = parametri.get("formato", OUTPUT_FORMAT).lower()
+    if formato not in FORMATI_OUTPUT:
+        raise ValueError(f"Formato di output non valido: {formato}")
+    codifica = {
+        "formato": formato,
+        "compressione": int(parametri.get("compressione", PNG_COMPRESS_LEVEL)),
+        "lossless": str(parametri.get("lossless", "1" if WEBP_LOSSLESS else "0")) == "1",
+        "qualita": int(parametri.get("qualita", WEBP_QUALITY))
+    }
+    if not 0 <= codifica["compressione"] <= 9:
+        raise ValueError("Il livello di compressione deve essere compreso tra 0 e 9")
+    if not 0 <= codifica["qualita"] <= 100:
+        raise ValueError("La qualità deve essere compresa tra 0 e 100")
+    return codifica
+
+# Funzione per codificare l'immagine finale secondo i parametri richiesti
+def codifica_immagine(final_image, codifica):
+    with misura("codifica"):
+        if OUTPUT_RGB and is_template_opaco():
+            final_image = final_image.convert("RGB")
+
+        buffer = BytesIO()
+        if codifica["formato"] == "webp":
+            final_image.save(
+                buffer,
+                format="WEBP",
+                lossless=codifica["lossless"],
+                quality=codifica["qualita"],
+                method=WEBP_METHOD
+            )
+        else:
+            final_image.save(buffer, format="PNG", compress_level=codifica["compressione"])
+        return buffer.getvalue()
+
+# Funzione per renderizzare il certificato e codificarlo.
+# È una funzione di modulo perché viene eseguita anche nei processi del pool per i batch
+def renderizza_immagine(codice_riferimento, valori_centro, codifica):
+    final_image = renderizza_certificato(codice_riferimento, valori_centro)
+    return codifica_immagine(final_image, codifica)
+
+# Funzione per calcolare l'hash di template e font, letto una sola volta per processo
+def get_versione_risorse():
+    global versione_risorse
+    if versione_risorse is None:
+        digest = hashlib.sha256()
+        for percorso in FILE_RISORSE:
+            with open(percorso, "rb") as f:
+                digest.update(f.read())
+        versione_risorse = digest.hexdigest()
+    return versione_risorse
+
+# Funzione per calcolare la chiave di cache di un certificato: dipende solo da ciò che finisce
+# nell'immagine (valori già normalizzati, codice di riferimento, modalità, codifica) e dalla versione delle risorse
+def chiave_render_cache(certificato, codifica):
+    dati = {
+        "codice_riferimento": certificato["codice_riferimento"],
+        "valori_centro": certificato["valori_centro"],
+        "modalita": RENDER_MODE,
+        "codifica": codifica,
+        "rgb": OUTPUT_RGB,
+        "risorse": get_versione_risorse()
+    }
+    return hashlib.sha256(json.dumps(dati, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Funzione per cercare un'immagine già generata, prima in memoria e poi su disco
+def cerca_render_cache(chiave, formato):
+    global render_cache_disco_hit
+    adesso = time.time()
+    render_cache.rimuovi_se(lambda voce: voce["scadenza"] <= adesso)
+    voce = render_cache.get(chiave)
+    if voce is not None or not RENDER_CACHE_DIR:
+        return voce
+    try:
+        with open(os.path.join(RENDER_CACHE_DIR, f"{chiave}.json")) as f:
+            dati = json.load(f)
+        if dati["scadenza"] <= adesso:
+            return None
+        with open(os.path.join(RENDER_CACHE_DIR, f"{chiave}.{formato}"), "rb") as f:
+            immagine = f.read()
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    voce = {"immagine": immagine, "imgbb_url": dati["imgbb_url"], "scadenza": dati["scadenza"]}
+    render_cache.put(chiave, voce)
+    render_cache_disco_hit += 1
+    return voce
+
+# Funzione per salvare un'immagine caricata nella cache in memoria e, se configurata, su disco
+def salva_render_cache(chiave, formato, immagine, imgbb_url):
+    scadenza = time.time() + RENDER_CACHE_DURATA
+    render_cache.put(chiave, {"immagine": immagine, "imgbb_url": imgbb_url, "scadenza": scadenza})
+    if not RENDER_CACHE_DIR:
+        return
+    try:
+        os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+        pota_render_cache_disco()
+        # Scrittura su file temporaneo e rename, così un'altra istanza non legge mai file a metà.
+        # Il JSON viene scritto per ultimo: senza di esso l'immagine non viene mai letta
+        dati = {"imgbb_url": imgbb_url, "scadenza": scadenza}
+        for estensione, contenuto in ((formato, immagine), ("json", json.dumps(dati).encode("utf-8"))):
+            percorso = os.path.join(RENDER_CACHE_DIR, f"{chiave}.{estensione}")
+            temporaneo = f"{percorso}.{os.getpid()}.tmp"
+            with open(temporaneo, "wb") as f:
+                f.write(contenuto)
+            os.replace(temporaneo, percorso)
+    except OSError as e:
+        logging.error(f"Errore durante il salvataggio nella cache su disco: {str(e)}")
+
+# Funzione per eliminare dalla cache su disco i file scaduti (più vecchi di RENDER_CACHE_DURATA secondi)
+# e, se i rimanenti superano RENDER_CACHE_DIR_MAX_BYTES, i più vecchi fino a rientrare nel limite
+def pota_render_cache_disco():
+    limite_scadenza = time.time() - RENDER_CACHE_DURATA
+    rimasti = []
+    for voce in os.scandir(RENDER_CACHE_DIR):
+        # Solo i file della cache: il nome inizia con la chiave sha256 esadecimale
+        chiave = voce.name.partition(".")[0]
+        if len(chiave) != 64 or any(c not in "0123456789abcdef" for c in chiave):
+            continue
+        try:
+            if not voce.is_file():
+                continue
+            info = voce.stat()
+            if info.st_mtime < limite_scadenza:
+                os.remove(voce.path)
+            else:
+                rimasti.append((info.st_mtime, info.st_size, voce.path))
+        except OSError:
+            pass
+    occupazione = sum(dimensione for _, dimensione, _ in rimasti)
+    for _, dimensione, percorso in sorted(rimasti):
+        if occupazione <= RENDER_CACHE_DIR_MAX_BYTES:
+            break
+        try:
+            os.remove(percorso)
+        except OSError:
+            pass
+        occupazione -= dimensione
+
+# Context manager che fornisce il pool di processi usato per renderizzare un batch, creandolo se serve.
+# I processi partono da un forkserver e non da un fork del worker: un fork mentre altri thread
+# tengono i lock di metriche, cache o logging lascerebbe quei lock bloccati nel figlio.
+# Il forkserver non precarica l'app, così il processo che resta attivo tra un pool e l'altro è leggero
+@contextmanager
+def usa_process_pool():
+    global process_pool, batch_in_corso, ultimo_batch
+    with risorse_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=precarica_risorse
+            )
+        pool = process_pool
+        batch_in_corso += 1
+    try:
+        yield pool
+    finally:
+        with risorse_lock:
+            batch_in_corso -= 1
+            ultimo_batch = time.monotonic()
+        chiusura = threading.Timer(BATCH_POOL_INATTIVO, chiudi_process_pool_inattivo)
+        chiusura.daemon = True
+        chiusura.start()
+
+# Funzione per chiudere il pool se nessun batch lo usa da almeno BATCH_POOL_INATTIVO secondi
+def chiudi_process_pool_inattivo():
+    global process_pool
+    with risorse_lock:
+        pool = process_pool
+        if pool is None or batch_in_corso or time.monotonic() - ultimo_batch < BATCH_POOL_INATTIVO:
+            return
+        process_pool = None
+    pool.shutdown(wait=False)
+
+# Funzione per scartare un pool rotto (per esempio un processo terminato dal sistema),
+# così il batch successivo ne crea uno nuovo invece di fallire per sempre
+def scarta_process_pool(pool):
+    global process_pool
+    with risorse_lock:
+        if process_pool is pool:
+            process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
 # Route per la home page con il form aggiornato
 @app.route("/")
 def home():
@@ -128,103 +865,191 @@ def home():
 def genera_immagine():
     try:
         # Ottieni i parametri dal form
-        nome = request.args.get("nome", "Nome Cognome").replace("_", " ")
-        importo = request.args.get("importo", "40000").replace(".", "").replace(",", "").replace("$", "")
         rendimento_selezionato = request.args.get("rendimento", "25%")
 
         # Aggiungi log per debug
-        logging.debug(f"Rendimento Selezionato: {rendimento_selezionato}")
-        # Mappa il rendimento selezionato al tipo di investimento
-        if rendimento_selezionato == "11%":
-            tipo_investimento = "7GG"
-        elif rendimento_selezionato == "25%":
-            tipo_investimento = "BASSO 14GG"
-        elif rendimento_selezionato == "37%":
-            tipo_investimento = "BASSO 21GG"
-        elif "23%" in rendimento_selezionato:
-            tipo_investimento = "ALTO 14GG"
-        elif "34%" in rendimento_selezionato:
-            tipo_investimento = "ALTO 21GG"
-        else:
-            tipo_investimento = "UNKNOWN"
+        logging.debug("Rendimento Selezionato: %s", rendimento_selezionato)
+        certificato = prepara_certificato(
+            request.args.get("nome", "Nome Cognome"),
+            request.args.get("importo"),
+            rendimento_selezionato
+        )
 
         # Aggiungi log per debug
-        logging.debug(f"Tipo di Investimento Mappato: {tipo_investimento}")
+        logging.debug("Tipo di Investimento Mappato: %s", certificato["tipo_investimento"])
         # Verifica se il tipo di investimento è stato riconosciuto
-        if tipo_investimento == "UNKNOWN":
+        if certificato["tipo_investimento"] == "UNKNOWN":
             logging.error("Tipo di investimento non riconosciuto")
+            conta_errore("tipo_sconosciuto")
             return jsonify({"error": "Tipo di investimento non riconosciuto"}), 400
 
-        # Calcola la data di scadenza in base al tipo di investimento
-        data_scadenza = calcola_data_scadenza(tipo_investimento)
-        codice_riferimento = genera_codice_riferimento()
-
-        # Data dell'investimento (la data corrente)
-        fuso_orario_italia = pytz.timezone('Europe/Rome')
-        data_investimento = datetime.now(fuso_orario_italia).strftime("%d/%m/%Y")
-
-        # Invia i dati a Google Sheet
-        if invia_a_google_sheet(nome, importo, tipo_investimento, data_investimento):
-            # Usa l'immagine e i font dalla cache
-            image = get_base_image()
-            txt_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(txt_layer)
-
-            # Font cachati
-            font_above = get_font("lumios_typewriter_tape", 326)
-            font_below = get_font("lumios_typewriter_tape", 326)
-            font_center = get_font("lumios_typewriter_new", 81)
-
-            # Colori e trasparenza
-            color_above = (134, 81, 0, int(28 * 2.55))
-            color_below = (31, 59, 0, int(63 * 2.55))
-            color_center = (43, 43, 43, 255)
-
-            # Testo centrale personalizzato
-            text_center = [
-                (f"Titolare: {nome}", 871.07, 694.60),
-                (f"Importo Investito: {request.args.get('importo', '40.000,00 $')}", 871.07, 806.92),
-                (f"Rendimento Promesso: {'variabile dal 23% al 30%' if '23%' in rendimento_selezionato else rendimento_selezionato}", 871.07, 919.24),
-                (f"Data di Scadenza: {data_scadenza}", 871.07, 1031.56),
-                (f"Codice di Riferimento Unico: {codice_riferimento}", 871.07, 1143.87)
-            ]
-
-            # Posizione del testo sopra (con opacità al 28%)
-            draw.text((2980.39, 588.83), codice_riferimento, font=font_above, fill=color_above, anchor="rd")
-
-            # Testo centrale, con i valori personalizzati
-            for line, x, y in text_center:
-                draw.text((x, y), line, font=font_center, fill=color_center)
-
-            # Posizione del testo sotto (con opacità al 63%)
-            draw.text((-50.57, 1494.53), codice_riferimento, font=font_below, fill=color_below, anchor="la")
-
-            # Combina il layer di testo con l'immagine di base
-            final_image = Image.alpha_composite(image, txt_layer)
-
-            # Riduci le dimensioni dell'immagine (es. 50% della risoluzione originale)
-            new_size = (int(final_image.width * 0.5), int(final_image.height * 0.5))
-            final_image = final_image.resize(new_size, Image.Resampling.LANCZOS)
+        # Formato e parametri di codifica dell'immagine
+        try:
+            codifica = leggi_codifica(request.args)
+        except ValueError as e:
+            logging.error(f"Parametri di codifica non validi: {str(e)}")
+            conta_errore("codifica_non_valida")
+            return jsonify({"error": str(e)}), 400
 
-            # Salva l'immagine su un buffer
-            buffer = BytesIO()
-            final_image.save(buffer, format="PNG")
-            buffer.seek(0)
+        # Un certificato identico è già stato registrato e caricato (per esempio un form inviato due volte)
+        chiave = chiave_render_cache(certificato, codifica)
+        voce = cerca_render_cache(chiave, codifica["formato"])
+        if voce is not None:
+            return jsonify({"imgbb_url": voce["imgbb_url"]})
 
+        # Invia i dati a Google Sheet in parallelo al rendering dell'immagine
+        invio_sheet = get_io_executor().submit(
+            invia_a_google_sheet,
+            certificato["nome"],
+            certificato["importo"],
+            certificato["tipo_investimento"],
+            certificato["data_investimento"]
+        )
+
+        # Salva l'immagine su un buffer
+        immagine = renderizza_immagine(certificato["codice_riferimento"], certificato["valori_centro"], codifica)
+        buffer = BytesIO(immagine)
+
+        # L'immagine viene caricata solo se i dati sono stati registrati sul foglio
+        if invio_sheet.result():
             # Carica l'immagine su FiveManage
-            imgbb_url = carica_su_fivemanage(buffer, "LvTU9eoJ9aVelrBG7ClyjbaAifIvhxHi")
+            imgbb_url = carica_su_fivemanage(buffer, FIVEMANAGE_API_KEY, codifica["formato"])
 
             if imgbb_url:
+                salva_render_cache(chiave, codifica["formato"], immagine, imgbb_url)
                 return jsonify({"imgbb_url": imgbb_url})
             else:
                 logging.error("Errore nel caricamento su FiveManage")
+                conta_errore("fivemanage")
                 return jsonify({"error": "Errore nel caricamento su FiveManage"}), 500
         else:
             logging.error("Errore nell'invio dei dati a Google Sheet")
+            conta_errore("google_sheet")
             return jsonify({"error": "Errore nell'invio dei dati a Google Sheet"}), 500
     except Exception as e:
         logging.error(f"Errore durante la generazione dell'immagine: {str(e)}")
+        conta_errore("generazione")
         return jsonify({"error": "Errore durante la generazione dell'immagine"}), 500
 
+# Route per generare più immagini con una sola richiesta.
+# Accetta una lista JSON di voci {nome, importo, rendimento} e restituisce un risultato
+# NDJSON per ogni voce, nell'ordine in cui le immagini vengono completate
+@app.route("/genera_immagini", methods=["POST"])
+def genera_immagini():
+    voci = request.get_json(silent=True)
+    if not isinstance(voci, list) or not voci:
+        return jsonify({"error": "Il corpo della richiesta deve essere una lista JSON non vuota"}), 400
+    if len(voci) > BATCH_MAX_VOCI:
+        return jsonify({"error": f"Sono ammesse al massimo {BATCH_MAX_VOCI} voci per richiesta"}), 400
+
+    # La codifica, indicata nella query string, vale per tutte le voci del batch
+    try:
+        codifica = leggi_codifica(request.args)
+    except ValueError as e:
+        conta_errore("codifica_non_valida")
+        return jsonify({"error": str(e)}), 400
+
+    # Voci identiche dello stesso batch hanno la stessa chiave: vengono renderizzate, scritte sul foglio
+    # e caricate una volta sola, e lo stesso risultato vale per tutti i loro indici
+    certificati = {}
+    indici_per_chiave = {}
+    risultati_immediati = []
+    for indice, voce in enumerate(voci):
+        if not isinstance(voce, dict):
+            risultati_immediati.append({"indice": indice, "error": "Voce non valida"})
+            continue
+        certificato = prepara_certificato(
+            str(voce.get("nome", "Nome Cognome")),
+            str(voce["importo"]) if voce.get("importo") is not None else None,
+            str(voce.get("rendimento", "25%"))
+        )
+        if certificato["tipo_investimento"] == "UNKNOWN":
+            conta_errore("tipo_sconosciuto")
+            risultati_immediati.append({"indice": indice, "error": "Tipo di investimento non riconosciuto"})
+            continue
+        certificato["chiave"] = chiave_render_cache(certificato, codifica)
+        voce = cerca_render_cache(certificato["chiave"], codifica["formato"])
+        if voce is not None:
+            risultati_immediati.append({"indice": indice, "imgbb_url": voce["imgbb_url"]})
+            continue
+        if certificato["chiave"] not in certificati:
+            certificati[certificato["chiave"]] = certificato
+            indici_per_chiave[certificato["chiave"]] = []
+        indici_per_chiave[certificato["chiave"]].append(indice)
+
+    # Tutte le righe valide vengono scritte sul foglio con una sola chiamata, in parallelo al rendering
+    righe = [
+        {
+            "nome": c["nome"],
+            "importo": c["importo"],
+            "tipo_investimento": c["tipo_investimento"],
+            "data_investimento": c["data_investimento"]
+        }
+        for c in certificati.values()
+    ]
+    invio_sheet = get_io_executor().submit(invia_righe_a_google_sheet, righe) if righe else None
+
+    def elabora(pool, certificato):
+        try:
+            # Le fasi eseguite nei processi del pool arrivano su /metrics solo con PROMETHEUS_MULTIPROC_DIR:
+            # qui si misura comunque il rendering complessivo, attesa del pool compresa
+            with misura("rendering_batch"):
+                try:
+                    immagine = pool.submit(
+                        renderizza_immagine, certificato["codice_riferimento"], certificato["valori_centro"], codifica
+                    ).result()
+                except BrokenProcessPool:
+                    scarta_process_pool(pool)
+                    raise
+
+            # L'immagine viene caricata solo se i dati sono stati registrati sul foglio
+            if not invio_sheet.result():
+                conta_errore("google_sheet")
+                return {"error": "Errore nell'invio dei dati a Google Sheet"}
+
+            imgbb_url = carica_su_fivemanage(BytesIO(immagine), FIVEMANAGE_API_KEY, codifica["formato"])
+            if imgbb_url:
+                salva_render_cache(certificato["chiave"], codifica["formato"], immagine, imgbb_url)
+                return {"imgbb_url": imgbb_url}
+            conta_errore("fivemanage")
+            return {"error": "Errore nel caricamento su FiveManage"}
+        except Exception as e:
+            indici = indici_per_chiave[certificato["chiave"]]
+            logging.error(f"Errore durante la generazione dell'immagine {indici}: {str(e)}")
+            conta_errore("generazione")
+            return {"error": "Errore durante la generazione dell'immagine"}
+
+    def genera():
+        for risultato in risultati_immediati:
+            yield json.dumps(risultato) + "\n"
+        if not certificati:
+            return
+        with usa_process_pool() as pool, ThreadPoolExecutor(max_workers=min(len(certificati), HTTP_POOL_SIZE)) as executor:
+            futures = {executor.submit(elabora, pool, c): chiave for chiave, c in certificati.items()}
+            for future in as_completed(futures):
+                risultato = future.result()
+                for indice in indici_per_chiave[futures[future]]:
+                    yield json.dumps({"indice": indice, **risultato}) + "\n"
+
+    return Response(genera(), mimetype="application/x-ndjson")
+
+# Route per consultare lo stato delle cache di rendering
+@app.route("/statistiche_cache")
+def statistiche_cache():
+    render = render_cache.statistiche()
+    render["disco_hit"] = render_cache_disco_hit
+    return jsonify({"sprite": sprite_cache.statistiche(), "render": render})
+
+# Route con le metriche in formato testo Prometheus. Con più worker gunicorn vengono sommati
+# i valori di tutti i processi, letti dalla cartella PROMETHEUS_MULTIPROC_DIR
+@app.route("/metrics")
+def metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    else:
+        registro = REGISTRY
+    return Response(generate_latest(registro), content_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     app.run(debug=True)
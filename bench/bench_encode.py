@@ -0,0 +1,64 @@
+# Benchmark della codifica dell'immagine finale: tempo di codifica e dimensione
+# in byte per ogni modalità di output, usando il template e i font reali.
+#
+# Uso: python bench/bench_encode.py [--iterazioni N]
+import argparse
+import statistics
+import time
+
+import comune
+
+comune.prepara_ambiente()
+
+import logging
+
+logging.disable(logging.CRITICAL)
+
+import app
+
+CODICE = "180120251230"
+VALORI_CENTRO = [
+    "Nome Cognome",
+    "40.000,00 $",
+    "25%",
+    "01/02/2025",
+    CODICE,
+]
+
+# Modalità confrontate: (descrizione, parametri di codifica, scarta alpha)
+MODALITA = [
+    ("PNG livello 6, RGBA (precedente)", {"formato": "png", "compressione": 6}, False),
+    ("PNG livello 1, RGB", {"formato": "png", "compressione": 1}, True),
+    ("PNG livello 3, RGB (predefinito)", {"formato": "png", "compressione": 3}, True),
+    ("PNG livello 6, RGB", {"formato": "png", "compressione": 6}, True),
+    ("PNG livello 9, RGB", {"formato": "png", "compressione": 9}, True),
+    ("WebP lossless, qualità 0", {"formato": "webp", "lossless": "1", "qualita": 0}, True),
+    ("WebP lossless, qualità 50", {"formato": "webp", "lossless": "1", "qualita": 50}, True),
+    ("WebP lossy, qualità 80", {"formato": "webp", "qualita": 80}, True),
+    ("WebP lossy, qualità 90", {"formato": "webp", "qualita": 90}, True),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterazioni", type=int, default=5)
+    args = parser.parse_args()
+
+    final_image = app.renderizza_certificato(CODICE, VALORI_CENTRO)
+    print(f"Immagine {final_image.width}x{final_image.height}, template opaco: {app.is_template_opaco()}")
+    print()
+    print(f"{'modalita':<36}{'codifica (ms)':>15}{'dimensione (KB)':>17}")
+
+    for descrizione, parametri, rgb in MODALITA:
+        app.OUTPUT_RGB = rgb
+        codifica = app.leggi_codifica(parametri)
+        tempi = []
+        for _ in range(args.iterazioni):
+            inizio = time.perf_counter()
+            dati = app.codifica_immagine(final_image, codifica)
+            tempi.append(time.perf_counter() - inizio)
+        print(f"{descrizione:<36}{statistics.median(tempi) * 1000:>15.1f}{len(dati) / 1024:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
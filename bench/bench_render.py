@@ -0,0 +1,105 @@
+# Benchmark del rendering: confronta la modalità "full" (disegno a piena
+# risoluzione + LANCZOS) con la modalità "scaled" (disegno alla risoluzione di output).
+#
+# Uso: python bench/bench_render.py [--iterazioni N]
+#
+# Ogni modalità viene misurata in un processo separato, così il picco di RSS
+# riportato appartiene solo a quella modalità.
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import comune
+
+comune.prepara_ambiente()
+
+import logging
+
+logging.disable(logging.CRITICAL)
+
+from PIL import ImageChops, ImageStat
+
+import app
+
+CODICE = "180120251230"
+VALORI_CENTRO = [
+    "Nome Cognome",
+    "40.000,00 $",
+    "25%",
+    "01/02/2025",
+    CODICE,
+]
+
+
+# Misura la latenza del rendering in una singola modalità (eseguita nel processo figlio)
+def misura_modalita(modalita, iterazioni):
+    inizio = time.perf_counter()
+    app.renderizza_certificato(CODICE, VALORI_CENTRO, modalita)
+    primo = time.perf_counter() - inizio
+
+    # Il nome cambia a ogni richiesta, come in produzione: non deve finire sempre in cache
+    tempi = []
+    for i in range(iterazioni):
+        valori = [f"Nome Cognome {i}"] + VALORI_CENTRO[1:]
+        inizio = time.perf_counter()
+        app.renderizza_certificato(CODICE, valori, modalita)
+        tempi.append(time.perf_counter() - inizio)
+
+    # ru_maxrss è in KB su Linux
+    picco_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "modalita": modalita,
+        "primo_ms": primo * 1000,
+        "media_ms": statistics.mean(tempi) * 1000,
+        "p50_ms": statistics.median(tempi) * 1000,
+        "picco_rss_mb": picco_rss / 1024,
+    }
+
+
+# Confronta pixel per pixel le due modalità
+def differenza_pixel():
+    full = app.renderizza_certificato(CODICE, VALORI_CENTRO, "full")
+    scaled = app.renderizza_certificato(CODICE, VALORI_CENTRO, "scaled")
+    diff = ImageChops.difference(full.convert("RGB"), scaled.convert("RGB"))
+    stat = ImageStat.Stat(diff)
+    massimo = max(hi for _, hi in diff.getextrema())
+    diversi = sum(diff.convert("L").histogram()[9:])
+    return {
+        "dimensioni": f"{full.width}x{full.height}",
+        "media_diff": sum(stat.mean) / len(stat.mean),
+        "max_diff": massimo,
+        "pixel_diversi_pct": diversi * 100 / (full.width * full.height),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterazioni", type=int, default=20)
+    parser.add_argument("--figlio", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.figlio:
+        print(json.dumps(misura_modalita(args.figlio, args.iterazioni)))
+        return
+
+    print(f"{'modalita':<10}{'primo (ms)':>12}{'media (ms)':>12}{'p50 (ms)':>12}{'picco RSS (MB)':>16}")
+    for modalita in ("full", "scaled"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--figlio", modalita, "--iterazioni", str(args.iterazioni)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(f"{r['modalita']:<10}{r['primo_ms']:>12.1f}{r['media_ms']:>12.1f}{r['p50_ms']:>12.1f}{r['picco_rss_mb']:>16.1f}")
+
+    d = differenza_pixel()
+    print()
+    print(f"Differenza full vs scaled ({d['dimensioni']}): media {d['media_diff']:.3f}, "
+          f"massima {d['max_diff']}, pixel con diff > 8: {d['pixel_diversi_pct']:.3f}%")
+
+
+if __name__ == "__main__":
+    main()
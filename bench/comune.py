@@ -0,0 +1,60 @@
+# Funzioni condivise dagli script di benchmark
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Valori validi del parametro "rendimento", usati a rotazione dai benchmark
+RENDIMENTI = ["11%", "25%", "37%", "variabile dal 23% al 30%", "variabile dal 34% al 45%"]
+
+
+# Rende importabile `app` e imposta la cartella di lavoro che l'app si aspetta (static/ e fonts/)
+def prepara_ambiente():
+    os.chdir(ROOT)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+# Percentile con interpolazione lineare su una lista di valori
+def percentile(valori, p):
+    if not valori:
+        return 0.0
+    ordinati = sorted(valori)
+    posizione = (len(ordinati) - 1) * p / 100
+    inferiore = int(posizione)
+    superiore = min(inferiore + 1, len(ordinati) - 1)
+    return ordinati[inferiore] + (ordinati[superiore] - ordinati[inferiore]) * (posizione - inferiore)
+
+
+# Memoria residente (RSS) e proporzionale (PSS) di un processo in MB, lette da /proc
+def memoria_processo(pid):
+    memoria = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for riga in f:
+                campo, _, valore = riga.partition(":")
+                if campo in ("Rss", "Pss"):
+                    memoria[campo.lower() + "_mb"] = int(valore.split()[0]) / 1024
+    except OSError:
+        pass
+    return memoria
+
+
+# Salva i risultati di un benchmark in JSON, per confrontarli con un'esecuzione successiva
+def salva_risultati(percorso, risultati):
+    with open(percorso, "w") as f:
+        json.dump(risultati, f, indent=2, sort_keys=True)
+
+
+# Carica i risultati di un'esecuzione precedente
+def carica_risultati(percorso):
+    with open(percorso) as f:
+        return json.load(f)
+
+
+# Variazione percentuale rispetto a un valore di riferimento, formattata per le tabelle
+def variazione(attuale, riferimento):
+    if not riferimento:
+        return ""
+    return f"{(attuale - riferimento) * 100 / riferimento:+.1f}%"
@@ -0,0 +1,88 @@
+# Server HTTP locale che simula l'Apps Script di Google Sheet e l'API immagini di FiveManage,
+# con latenza configurabile, per eseguire i benchmark senza rete.
+#
+# Uso: python bench/fake_server.py [--porta 8765] [--latenza-sheet 0.3] [--latenza-upload 0.2]
+#
+# Endpoint:
+#   POST /sheet  risponde "ok" dopo la latenza dello Sheet
+#   POST /image  risponde {"url": ...} dopo la latenza dell'upload
+#
+# Per puntare l'app a questo server:
+#   GOOGLE_SHEET_URL=http://127.0.0.1:8765/sheet FIVEMANAGE_URL=http://127.0.0.1:8765/image
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class GestoreFinto(BaseHTTPRequestHandler):
+    # HTTP/1.1 per mantenere le connessioni keep-alive, come i servizi reali
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def attendi(self, latenza):
+        jitter = self.server.jitter
+        time.sleep(max(0.0, latenza + random.uniform(-jitter, jitter)))
+
+    def rispondi(self, codice, corpo, content_type):
+        self.send_response(codice)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_POST(self):
+        lunghezza = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(lunghezza)
+
+        with self.server.lock:
+            self.server.conteggi[self.path] = self.server.conteggi.get(self.path, 0) + 1
+            numero = self.server.conteggi[self.path]
+
+        if self.path == "/sheet":
+            self.attendi(self.server.latenza_sheet)
+            self.rispondi(200, b"ok", "text/plain")
+        elif self.path == "/image":
+            self.attendi(self.server.latenza_upload)
+            corpo = json.dumps({"url": f"http://fake.local/image/{numero}.png", "byte": lunghezza})
+            self.rispondi(200, corpo.encode("utf-8"), "application/json")
+        else:
+            self.rispondi(404, b"not found", "text/plain")
+
+
+# Avvia il server in un thread e restituisce (server, url base); porta 0 sceglie una porta libera
+def avvia_server(porta=0, latenza_sheet=0.0, latenza_upload=0.0, jitter=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", porta), GestoreFinto)
+    server.daemon_threads = True
+    server.latenza_sheet = latenza_sheet
+    server.latenza_upload = latenza_upload
+    server.jitter = jitter
+    server.lock = threading.Lock()
+    server.conteggi = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--latenza-sheet", type=float, default=0.3, help="secondi")
+    parser.add_argument("--latenza-upload", type=float, default=0.2, help="secondi")
+    parser.add_argument("--jitter", type=float, default=0.0, help="variazione casuale massima, in secondi")
+    args = parser.parse_args()
+
+    server, url = avvia_server(args.porta, args.latenza_sheet, args.latenza_upload, args.jitter)
+    print(f"GOOGLE_SHEET_URL={url}/sheet FIVEMANAGE_URL={url}/image")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# Load test di /genera_immagine senza rete: Google Sheet e FiveManage sono sostituiti
+# dal server finto di fake_server.py, con latenza configurabile.
+#
+# Uso:
+#   python bench/load_test.py --modalita client --richieste 50 --concorrenza 4
+#   python bench/load_test.py --modalita gunicorn --workers 3 --richieste 200 --concorrenza 8
+#
+# In modalità "client" l'app viene eseguita in questo processo tramite il test client di Flask;
+# in modalità "gunicorn" viene avviato un vero gunicorn con N worker (con gunicorn.conf.py,
+# oppure senza preload con --senza-preload).
+#
+# Riporta richieste al secondo, latenze p50/p95/p99 e memoria di ogni worker.
+# Con --salva e --confronta i risultati vengono salvati in JSON e confrontati tra esecuzioni.
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+import comune
+from fake_server import avvia_server
+
+
+# Parametri della i-esima richiesta: il nome cambia sempre, così la cache delle immagini
+# non viene colpita a meno di chiederlo con --stesso-nome
+def parametri_richiesta(i, args):
+    parametri = {
+        "nome": "Nome Cognome" if args.stesso_nome else f"Bench {i}",
+        "importo": "40.000,00 $",
+        "rendimento": comune.RENDIMENTI[i % len(comune.RENDIMENTI)]
+    }
+    if args.formato:
+        parametri["formato"] = args.formato
+    return parametri
+
+
+# Esegue le richieste con `concorrenza` thread; esegui(i) restituisce il codice di stato HTTP
+def esegui_carico(esegui, args):
+    latenze = []
+    errori = []
+    prossima = iter(range(args.richieste))
+    lock = threading.Lock()
+
+    def lavoratore():
+        while True:
+            with lock:
+                i = next(prossima, None)
+            if i is None:
+                return
+            inizio = time.perf_counter()
+            try:
+                stato = esegui(i)
+            except Exception as e:
+                stato = repr(e)
+            durata = time.perf_counter() - inizio
+            with lock:
+                latenze.append(durata)
+                if stato != 200:
+                    errori.append(stato)
+
+    inizio = time.perf_counter()
+    threads = [threading.Thread(target=lavoratore) for _ in range(args.concorrenza)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    totale = time.perf_counter() - inizio
+
+    return {
+        "richieste": len(latenze),
+        "errori": len(errori),
+        "durata_s": totale,
+        "rps": len(latenze) / totale,
+        "p50_ms": comune.percentile(latenze, 50) * 1000,
+        "p95_ms": comune.percentile(latenze, 95) * 1000,
+        "p99_ms": comune.percentile(latenze, 99) * 1000
+    }
+
+
+# Configurazione dell'app che la fa puntare al server finto
+def ambiente_app(url_finto):
+    ambiente = dict(os.environ)
+    ambiente.update({
+        "GOOGLE_SHEET_URL": f"{url_finto}/sheet",
+        "FIVEMANAGE_URL": f"{url_finto}/image",
+        "LOG_LEVEL": "WARNING"
+    })
+    ambiente.pop("RENDER_CACHE_DIR", None)
+    return ambiente
+
+
+def carico_client(args, url_finto):
+    os.environ.update(ambiente_app(url_finto))
+    comune.prepara_ambiente()
+    import app
+
+    # Un test client per thread
+    locale = threading.local()
+
+    def esegui(i):
+        if not hasattr(locale, "client"):
+            locale.client = app.app.test_client()
+        risposta = locale.client.get("/genera_immagine?" + urlencode(parametri_richiesta(i, args)))
+        return risposta.status_code
+
+    # Carica template e font prima della misura, come farebbe il preload di gunicorn
+    app.precarica_risorse()
+    risultati = esegui_carico(esegui, args)
+    risultati["memoria_worker"] = [comune.memoria_processo(os.getpid())]
+    return risultati
+
+
+# Porta TCP libera per gunicorn
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# PID dei processi figli (i worker) del master gunicorn
+def figli(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def carico_gunicorn(args, url_finto):
+    import requests
+
+    porta = porta_libera()
+    comando = [
+        sys.executable, "-m", "gunicorn",
+        "-w", str(args.workers),
+        "-b", f"127.0.0.1:{porta}",
+        "--log-level", "warning"
+    ]
+    # Un file di configurazione vuoto sostituisce gunicorn.conf.py, quindi niente preload
+    config_vuota = tempfile.NamedTemporaryFile(suffix=".py")
+    if args.senza_preload:
+        comando += ["-c", config_vuota.name]
+    comando.append("app:app")
+    processo = subprocess.Popen(comando, cwd=comune.ROOT, env=ambiente_app(url_finto))
+
+    base = f"http://127.0.0.1:{porta}"
+    try:
+        # Attendi che tutti i worker siano avviati
+        limite = time.time() + 60
+        while time.time() < limite:
+            try:
+                requests.get(f"{base}/metrics", timeout=1)
+                if len(figli(processo.pid)) >= args.workers:
+                    break
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.2)
+        else:
+            raise RuntimeError("gunicorn non si è avviato entro 60 secondi")
+
+        locale = threading.local()
+
+        def esegui(i):
+            if not hasattr(locale, "session"):
+                locale.session = requests.Session()
+            risposta = locale.session.get(f"{base}/genera_immagine", params=parametri_richiesta(i, args), timeout=120)
+            return risposta.status_code
+
+        risultati = esegui_carico(esegui, args)
+        risultati["memoria_master"] = comune.memoria_processo(processo.pid)
+        risultati["memoria_worker"] = [comune.memoria_processo(pid) for pid in figli(processo.pid)]
+        return risultati
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+        config_vuota.close()
+
+
+def stampa(risultati, riferimento):
+    print(f"{'metrica':<14}{'valore':>12}{'riferimento':>14}{'variazione':>12}")
+    for campo in ("richieste", "errori", "rps", "p50_ms", "p95_ms", "p99_ms"):
+        valore = risultati[campo]
+        prima = riferimento.get(campo) if riferimento else None
+        colonna_prima = f"{prima:>14.1f}" if prima is not None else f"{'':>14}"
+        print(f"{campo:<14}{valore:>12.1f}{colonna_prima}{comune.variazione(valore, prima) if prima is not None else '':>12}")
+
+    print()
+    if "memoria_master" in risultati:
+        memoria = risultati["memoria_master"]
+        print(f"master: RSS {memoria.get('rss_mb', 0):.1f} MB, PSS {memoria.get('pss_mb', 0):.1f} MB")
+    for i, memoria in enumerate(risultati["memoria_worker"]):
+        print(f"worker {i}: RSS {memoria.get('rss_mb', 0):.1f} MB, PSS {memoria.get('pss_mb', 0):.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modalita", choices=("client", "gunicorn"), default="client")
+    parser.add_argument("--workers", type=int, default=2, help="worker gunicorn")
+    parser.add_argument("--senza-preload", action="store_true", help="avvia gunicorn senza gunicorn.conf.py")
+    parser.add_argument("--richieste", type=int, default=50)
+    parser.add_argument("--concorrenza", type=int, default=4)
+    parser.add_argument("--latenza-sheet", type=float, default=0.3, help="secondi")
+    parser.add_argument("--latenza-upload", type=float, default=0.2, help="secondi")
+    parser.add_argument("--jitter", type=float, default=0.0, help="secondi")
+    parser.add_argument("--formato", help="formato di output richiesto (png, webp)")
+    parser.add_argument("--stesso-nome", action="store_true", help="richieste identiche, per misurare la cache")
+    parser.add_argument("--salva", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--confronta", help="file JSON di un'esecuzione precedente")
+    args = parser.parse_args()
+
+    server, url_finto = avvia_server(0, args.latenza_sheet, args.latenza_upload, args.jitter)
+    try:
+        if args.modalita == "client":
+            risultati = carico_client(args, url_finto)
+        else:
+            risultati = carico_gunicorn(args, url_finto)
+    finally:
+        server.shutdown()
+
+    riferimento = comune.carica_risultati(args.confronta) if args.confronta else None
+    print(f"Modalità {args.modalita}, {args.richieste} richieste, concorrenza {args.concorrenza}, "
+          f"latenza Sheet {args.latenza_sheet}s, upload {args.latenza_upload}s")
+    print()
+    stampa(risultati, riferimento)
+
+    if args.salva:
+        comune.salva_risultati(args.salva, risultati)
+
+
+if __name__ == "__main__":
+    main()
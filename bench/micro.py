@@ -0,0 +1,92 @@
+# Micro-benchmark dei singoli passi di genera_immagine, con template e font reali.
+#
+# Uso:
+#   python bench/micro.py [--iterazioni N] [--salva risultati.json] [--confronta precedente.json]
+#
+# Con --salva e --confronta si confrontano due esecuzioni, per esempio prima e dopo una modifica
+# al rendering. Le chiamate HTTP non sono incluse: per quelle c'è load_test.py.
+import argparse
+import time
+
+import comune
+
+comune.prepara_ambiente()
+
+import logging
+
+logging.disable(logging.CRITICAL)
+
+import app
+
+CODICE = "180120251230"
+
+
+# Misura una funzione: la prima chiamata (a freddo) è esclusa dalle statistiche
+def misura(funzione, iterazioni):
+    funzione()
+    tempi = []
+    for i in range(iterazioni):
+        inizio = time.perf_counter()
+        funzione()
+        tempi.append(time.perf_counter() - inizio)
+    return {
+        "media_ms": sum(tempi) / len(tempi) * 1000,
+        "p50_ms": comune.percentile(tempi, 50) * 1000,
+        "p95_ms": comune.percentile(tempi, 95) * 1000
+    }
+
+
+def passi():
+    certificato = app.prepara_certificato("Nome Cognome", "40.000,00 $", "25%")
+    valori = certificato["valori_centro"]
+    png = app.leggi_codifica({"formato": "png"})
+    webp = app.leggi_codifica({"formato": "webp"})
+    scala = app.SCALA_OUTPUT
+    size_centro = app.DIM_FONT_CENTRO * scala
+    final_image = app.renderizza_certificato(CODICE, valori, "scaled")
+    template_full = app.get_template(1.0)
+    contatore = iter(range(10 ** 9))
+
+    return [
+        ("prepara_certificato", lambda: app.prepara_certificato("Nome Cognome", "40.000,00 $", "25%")),
+        ("chiave_render_cache", lambda: app.chiave_render_cache(certificato, png)),
+        ("copia template (scaled)", lambda: app.get_template(scala)),
+        ("copia template (full)", lambda: app.get_template(1.0)),
+        # Un testo sempre nuovo non è mai in cache: misura la rasterizzazione
+        ("sprite nome (miss)", lambda: app.sprite_testo(
+            (500.0, 400.0), final_image.size, f"Nome {next(contatore)}", "lumios_typewriter_new", size_centro, app.COLORE_CENTRO)),
+        ("sprite codice (hit)", lambda: app.sprite_testo(
+            (500.0, 400.0), final_image.size, CODICE, "lumios_typewriter_new", size_centro, app.COLORE_CENTRO)),
+        ("renderizza_certificato (scaled)", lambda: app.renderizza_certificato(CODICE, valori, "scaled")),
+        ("renderizza_certificato (full)", lambda: app.renderizza_certificato(CODICE, valori, "full")),
+        ("resize LANCZOS 3000->1500", lambda: template_full.resize(final_image.size, app.Image.Resampling.LANCZOS)),
+        ("codifica PNG", lambda: app.codifica_immagine(final_image, png)),
+        ("codifica WebP", lambda: app.codifica_immagine(final_image, webp)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterazioni", type=int, default=10)
+    parser.add_argument("--salva", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--confronta", help="file JSON di un'esecuzione precedente")
+    args = parser.parse_args()
+
+    riferimento = comune.carica_risultati(args.confronta) if args.confronta else {}
+    risultati = {}
+
+    print(f"{'passo':<34}{'media (ms)':>12}{'p50 (ms)':>12}{'p95 (ms)':>12}{'rif. p50':>12}{'variazione':>12}")
+    for nome, funzione in passi():
+        r = misura(funzione, args.iterazioni)
+        risultati[nome] = r
+        prima = riferimento.get(nome, {}).get("p50_ms")
+        colonna_prima = f"{prima:>12.2f}" if prima is not None else f"{'':>12}"
+        delta = comune.variazione(r["p50_ms"], prima) if prima is not None else ""
+        print(f"{nome:<34}{r['media_ms']:>12.2f}{r['p50_ms']:>12.2f}{r['p95_ms']:>12.2f}{colonna_prima}{delta:>12}")
+
+    if args.salva:
+        comune.salva_risultati(args.salva, risultati)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Configurazione gunicorn, letta automaticamente dalla cartella di avvio
+import gc
+import os
+import shutil
+import tempfile
+
+# Cartella in cui ogni worker scrive le proprie metriche Prometheus, sommate da /metrics.
+# Deve essere impostata prima che l'app venga importata e non va condivisa con altre istanze,
+# altrimenti ogni /metrics sommerebbe anche i valori delle altre. Di default ogni avvio crea una
+# cartella temporanea nuova e privata (permessi 0700), esportata ai worker ed eliminata in on_exit.
+# Se PROMETHEUS_MULTIPROC_DIR è indicata deve essere riservata a questa istanza e vuota all'avvio.
+# WS_METRICHE_TEMPORANEE ricorda quale master ha creato la cartella: un master nuovo avviato con
+# USR2 eredita l'ambiente del precedente, ma deve usare una cartella propria
+master_metriche, _, cartella_metriche = os.environ.get("WS_METRICHE_TEMPORANEE", "").partition(":")
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ or (
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] == cartella_metriche and master_metriche != str(os.getpid())
+):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="ws-metriche-")
+    os.environ["WS_METRICHE_TEMPORANEE"] = f"{os.getpid()}:{os.environ['PROMETHEUS_MULTIPROC_DIR']}"
+
+# Carica l'app nel master prima del fork: template e font vengono decodificati una volta sola
+# e le pagine restano condivise tra i worker
+preload_app = True
+
+# Secondi prima che un worker bloccato venga terminato. Una richiesta può attendere nel caso peggiore
+# Sheet e upload con tutti i retry (circa 2 x 40 s con i valori HTTP_* predefiniti) più il rendering;
+# per /genera_immagini il rendering dell'intero batch, limitato da BATCH_MAX_VOCI in app.py
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "90"))
+
+# Hook eseguito nel master, dopo il caricamento dell'app e prima della creazione dei worker
+def on_starting(server):
+    import app
+    app.precarica_risorse()
+
+    # Ogni worker crea il proprio pool per i batch: se BATCH_WORKERS non è indicata le CPU
+    # vengono divise tra i worker, invece di avviare un processo per CPU in ognuno
+    if "BATCH_WORKERS" not in os.environ:
+        app.BATCH_WORKERS = max(1, (os.cpu_count() or 1) // server.cfg.workers)
+
+    # Sposta gli oggetti già creati fuori dal garbage collector, così i worker non li
+    # riscrivono (e non duplicano le pagine condivise) a ogni ciclo di raccolta
+    gc.freeze()
+
+# Hook eseguito nel master quando un worker termina: i suoi valori restano nei totali,
+# ma le metriche "live" del processo non vengono più considerate
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+# Hook eseguito nel master all'uscita: elimina la cartella temporanea delle metriche creata all'avvio
+def on_exit(server):
+    master, _, cartella = os.environ.get("WS_METRICHE_TEMPORANEE", "").partition(":")
+    if master == str(os.getpid()):
+        shutil.rmtree(cartella, ignore_errors=True)
@@ -0,0 +1,126 @@
+# Test della politica di retry della sessione HTTP condivisa, contro un server locale.
+# Si ripetono solo le richieste che il server non ha elaborato (errori di connessione, 429/503):
+# un timeout di lettura o un 502/504 non devono mai causare un secondo invio dello stesso POST.
+#
+# Uso: python -m unittest discover tests   (oppure python -m pytest tests)
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Valori piccoli per tenere i test veloci; vanno impostati prima di importare l'app
+os.environ.update({
+    "HTTP_CONNECT_TIMEOUT": "0.5",
+    "HTTP_READ_TIMEOUT": "0.5",
+    "HTTP_RETRIES": "2",
+    "HTTP_BACKOFF": "1.0",
+    "LOG_LEVEL": "CRITICAL"
+})
+os.chdir(ROOT)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import requests
+
+import app
+
+
+# Server che risponde alle richieste successive secondo la lista `risposte`:
+# un codice HTTP, oppure "lenta" per rispondere 200 dopo il timeout di lettura del client
+class GestoreStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            risposta = self.server.risposte[min(self.server.richieste, len(self.server.risposte) - 1)]
+            self.server.richieste += 1
+        if risposta == "lenta":
+            time.sleep(1.5)
+            risposta = 200
+        try:
+            self.send_response(risposta)
+            # Un Retry-After lungo non deve far attendere il client
+            self.send_header("Retry-After", "120")
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+        except OSError:
+            pass
+
+
+def avvia_stub(risposte, porta=0):
+    server = ThreadingHTTPServer(("127.0.0.1", porta), GestoreStub)
+    server.daemon_threads = True
+    server.risposte = risposte
+    server.richieste = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestRetryHTTP(unittest.TestCase):
+    def invia(self, porta):
+        return app.get_http_session().post(f"http://127.0.0.1:{porta}/", data={"a": "1"}, timeout=app.HTTP_TIMEOUT)
+
+    def stub(self, risposte):
+        server = avvia_stub(risposte)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_errore_di_connessione_ripetuto(self):
+        # Il primo e il secondo tentativo trovano la porta chiusa; il server parte prima del terzo,
+        # che arriva dopo il backoff di 2 x HTTP_BACKOFF secondi
+        porta = porta_libera()
+        avviati = []
+        avvio = threading.Timer(0.5, lambda: avviati.append(avvia_stub([200], porta)))
+        avvio.start()
+        try:
+            risposta = self.invia(porta)
+        finally:
+            avvio.join()
+            for server in avviati:
+                self.addCleanup(server.server_close)
+                self.addCleanup(server.shutdown)
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(avviati[0].richieste, 1)
+
+    def test_timeout_di_lettura_non_ripetuto(self):
+        server = self.stub(["lenta", 200])
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.invia(server.server_address[1])
+        self.assertEqual(server.richieste, 1)
+
+    def test_503_ripetuto_una_volta(self):
+        server = self.stub([503, 200])
+        inizio = time.perf_counter()
+        risposta = self.invia(server.server_address[1])
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(server.richieste, 2)
+        # Il Retry-After di 120 s viene ignorato
+        self.assertLess(time.perf_counter() - inizio, 5)
+
+    def test_504_non_ripetuto(self):
+        server = self.stub([504, 200])
+        risposta = self.invia(server.server_address[1])
+        self.assertEqual(risposta.status_code, 504)
+        self.assertEqual(server.richieste, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()